@@ -0,0 +1,152 @@
+# Parsing of the HTML snippets with individual race reports from mtecresults.com
+# This module is written in Python that Cython can compile as is (see setup_extract.py).
+# The type annotations of the local variables let Cython use the C-level dict, list and str operations on them.
+# Without compiling, it runs as regular Python.
+
+import bs4
+import lxml.html
+from lxml import etree
+
+def xpath_class(*names):
+    # An XPath predicate matching the elements that have all the given classes.
+    return ' and '.join(f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')" for name in names)
+
+class SplitsParser:
+    # Parses the HTML snippets with individual race reports provided by the mtecresults server.
+    # A parser is set up once per scraping session, so that the lookup tables derived from the config parameters
+    # are not rebuilt for every runner.
+    # The reports are parsed with lxml directly. The previous implementation on top of BeautifulSoup is kept as a fallback,
+    # chosen by setting scraping: html_parser to 'bs4' in the config.
+    # NOTE: This is sensitive to the output format that mtecresults is currently using.
+
+    # The entries for the splits by segment are kept in a table within the 'detailedresultsseg' div-container.
+    # The entries for the cumulative splits are kept in a table within the 'detailedresultscum' div-container.
+    SPLITS_XPATH = etree.XPath(f"//div[{xpath_class('detailedresultsseg')}]")
+    # The personal data is kept in the 'me-auto mb-3 mb-md-0' div-container. The values are tagged by <strong>...</strong>
+    PERSONAL_XPATH = etree.XPath(f"//div[{xpath_class('me-auto', 'mb-3', 'mb-md-0')}]")
+    PERSONAL_VALUES_XPATH = etree.XPath(f".//strong[{xpath_class('text-primary')}]")
+
+    def __init__(self, config_params):
+        # Map user-readable column captions in an individual race report to the dataframe field names.
+        PANDAS_COL_MAP = config_params['column_mapping']
+        SPLITS_DISTANCE = config_params['splits']['distance']
+
+        # For each split label, map a column caption to the field name 'split_{i}_<field>', where i in 1...m is the split index and m is the finish line.
+        self.split_fields = {split: {col: f'split_{i}_' + field for col, field in PANDAS_COL_MAP.items()}
+                             for i, split in enumerate(SPLITS_DISTANCE, start=1)}
+        self.known_columns = frozenset(PANDAS_COL_MAP)
+        # Map the start labels (ChipStart, GunStart) to the field names.
+        self.start_fields = dict(config_params['splits']['start'])
+
+        HTML_PARSER = config_params['scraping'].get('html_parser', 'lxml')
+        if HTML_PARSER not in ('lxml', 'bs4'):
+            raise ValueError(f'Unknown HTML parser {HTML_PARSER}. Expected "lxml" or "bs4".')
+        self.parse = self.parse_lxml if HTML_PARSER == 'lxml' else self.parse_bs4
+
+    def read_splits(self, rows, runner_id):
+        # This takes the rows of the splits table for a single runner as lists of the cell texts,
+        # and returns the values as a dictionary {field_name: field_value}.
+        # We expect to see the column headers in the first row of the HTML table with a race report.
+        headers: list = next(rows, [])[1:] # Drop the first column title (it just says 'Location')
+        for col in headers:
+            if col not in self.known_columns:
+                print (f'Warning: unknown field "{col}" detected for runner {runner_id}.')
+
+        res: dict = {}
+        cells: list
+        values: list
+        fields: dict
+        for cells in rows:
+            # A row is a split label <th> followed by the <td> values.
+            if not cells:
+                continue
+            split_name, *values = cells
+            fields = self.split_fields.get(split_name)
+            if fields is not None:
+                for col, value in zip(headers, values):
+                    if col in fields:
+                        res[fields[col]] = value
+            elif split_name in self.start_fields:
+                # ChipStart, GunStart
+                res[self.start_fields[split_name]] = values[0]
+            else:
+                print (f'Warning: unknown split label "{split_name}" detected for runner {runner_id}.')
+
+        return res
+
+    def read_personal(self, values, runner_id):
+        # This takes the personal data values for a single runner (the runner's name is omitted) and returns them as a dictionary.
+        res: dict = {}
+        try:
+            # The expected order of the values appearance: the event type, runner's ID (which we already have by now), sex, age, residence.
+            res['event'], _, res['sex'], res['age'], res['residence'] = values
+        except Exception as e:
+            print(f'Warning: unexpected personal data format for runner {runner_id}. Error ({type(e).__name__}: {e})')
+            return {}
+
+        return res
+
+    def extract_splits_lxml(self, root, runner_id):
+        # Extract the data from the splits table of a race report parsed by lxml.
+        splits_table = next(iter(self.SPLITS_XPATH(root)), None)
+        if splits_table is None:
+            print (f'Warning: could not find splits data for runner {runner_id}. Skipping.')
+            return {}
+
+        # The cells are the direct children of a row. The text is collected by lxml in C.
+        rows = ([cell.text_content().strip() for cell in row.iterchildren('th', 'td')] for row in splits_table.iter('tr'))
+        return self.read_splits(rows, runner_id)
+
+    def extract_personal_lxml(self, root, runner_id):
+        # Extract the personal data from a race report parsed by lxml.
+        personal = next(iter(self.PERSONAL_XPATH(root)), None)
+        if personal is None:
+            print(f'Warning: could not find personal data for runner {runner_id}')
+            return {}
+
+        return self.read_personal([value.text_content().strip() for value in self.PERSONAL_VALUES_XPATH(personal)], runner_id)
+
+    def extract_splits_bs4(self, html_data, runner_id):
+        # Extract the data from the splits table of a race report parsed by BeautifulSoup.
+        splits_table = html_data.select_one('div.detailedresultsseg')
+        if not splits_table:
+            print (f'Warning: could not find splits data for runner {runner_id}. Skipping.')
+            return {}
+
+        rows = ([cell.get_text(strip=True) for cell in row.children if cell.name in ('th', 'td')] for row in splits_table.find_all('tr'))
+        return self.read_splits(rows, runner_id)
+
+    def extract_personal_bs4(self, html_data, runner_id):
+        # Extract the personal data from a race report parsed by BeautifulSoup.
+        personal = html_data.select_one('div.me-auto.mb-3.mb-md-0')
+        if not personal:
+            print(f'Warning: could not find personal data for runner {runner_id}')
+            return {}
+
+        return self.read_personal([value.get_text(strip=True) for value in personal.select('strong.text-primary')], runner_id)
+
+    def parse_lxml(self, text, runner_id):
+        # Parse the HTML text of a race report for a single runner and return the entry dictionary {field_name: field_value}.
+        entry = {'runner_id': runner_id}
+        try:
+            try:
+                root = lxml.html.fromstring(text)
+            except ValueError:
+                # lxml does not take a string that starts with an encoding declaration. The text is already decoded, so it is parsed as UTF-8 bytes.
+                root = lxml.html.fromstring(text.encode('utf-8'), parser=lxml.html.HTMLParser(encoding='utf-8'))
+        except (etree.ParserError, ValueError) as e:
+            print(f'Warning: could not parse the race report for runner {runner_id}: {e}')
+            return entry
+
+        entry.update(self.extract_personal_lxml(root, runner_id))
+        entry.update(self.extract_splits_lxml(root, runner_id))
+        return entry
+
+    def parse_bs4(self, text, runner_id):
+        # Same as parse_lxml, but on top of BeautifulSoup.
+        html_data = bs4.BeautifulSoup(text, 'lxml')
+
+        entry = {'runner_id': runner_id}
+        entry.update(self.extract_personal_bs4(html_data, runner_id))
+        entry.update(self.extract_splits_bs4(html_data, runner_id))
+        return entry
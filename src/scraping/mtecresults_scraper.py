@@ -1,84 +1,232 @@
 # A module for parsing HTML snippets with individual race reports from mtecresults.com
 # The custom parameters are in config/params.yaml
 
-import numpy as np, pandas as pd
-import bs4, requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-import itertools, os, random, time
+import pandas as pd
+import aiohttp
+from aiohttp_client_cache import CachedSession, SQLiteBackend
+import pyarrow as pa, pyarrow.compute as pc, pyarrow.parquet as pq
+import asyncio, contextlib, csv, itertools, os, shutil, sys
 import yaml
-from datetime import datetime
-
-def extract_splits(html_data, runner_id, config_params):
-    # This takes a HTML snippet for a single runner provided by the mtecresults server,
-    # extracts the data from the splits table and returns the values as a dictionary {field_name: field_value}.
-    # The entries for the splits by segment are kept in a table within the 'detailedresultsseg' div-container.
-    # The entries for the cumulative splits are kept in a table within the 'detailedresultscum' div-container.
-    # NOTE: This is sensitive to the table format that mtecresults is currently using.
-    
-    # Map user-readable column captions in an individual race report to the dataframe field names.
-    PANDAS_COL_MAP = config_params['column_mapping']    
-    PANDAS_START_MAP = config_params['splits']['start']
-    
-    SPLITS_DISTANCE = config_params['splits']['distance']    
-    # Map a split label to an index 1...m, where m is the finish line.
-    SPLITS_ORDER = {split: i for i, split in enumerate(SPLITS_DISTANCE, start=1)}
-    
-    splits_table = html_data.find('div', class_='detailedresultsseg')
-    if not splits_table:
-        print (f'Warning: could not find splits data for runner {runner_id}. Skipping.')
-        return {}
-        
-    rows = iter(splits_table.find_all('tr'))    
-    # We expect to see the column headers in the first row of the HTML table with a race report.
-    headers = [header.get_text(strip=True) for header in next(rows).find_all('th')]
-    headers.pop(0) # Drop the first column title (it just says 'Location')
-    
-    res = {}
-    for row in rows:
-        split_name = row.find('th').get_text(strip=True)
-        if split_name in SPLITS_ORDER:
-            for col, value in zip(headers, row.find_all('td')):
-                if col in PANDAS_COL_MAP:
-                    res[f'split_{SPLITS_ORDER[split_name]}_' + PANDAS_COL_MAP[col]] = value.get_text(strip=True)
-                else:
-                    print (f'Warning: unknown field "{col}" detected for runner {runner_id}.')
-        elif split_name in PANDAS_START_MAP:
-            # ChipStart, GunStart
-            res[PANDAS_START_MAP[split_name]] = row.find('td').get_text(strip=True)
-        else:
-            print (f'Warning: unknown split label "{split_name}" detected for runner {runner_id}.')
-           
-    return res 
-
-def extract_personal(html_data, runner_id):
-    # This takes a HTML snippet for a single runner returned by the mtecresults server, 
-    # extracts the personal data (the runner's name is omitted) and returns the values.
-    # The personal data is kept in the 'me-auto mb-3 mb-md-0' div-container.
-    #
-    # Note that this is sensitive to the output format that mtecresults is currently using.
-
-    personal = html_data.find('div', class_='me-auto mb-3 mb-md-0')    
-    if not personal:
-        print(f'Warning: could not find personal data for runner {runner_id}')
-        return {}   
-        
-    # The personal data values are tagged by <strong>...</strong>
-    res = {}
+
+# The race report parser. It can be compiled with Cython, see setup_extract.py.
+# The relative import works when this module is imported as a part of the src.scraping package, the absolute one when it is run as a script.
+try:
+    from .extract import SplitsParser
+except ImportError:
+    from extract import SplitsParser
+
+async def parse_entry(parser, text, runner_id):
+    # Parsing is CPU work. It is done in a worker thread, so that the event loop keeps sending requests in the meantime.
+    return await asyncio.to_thread(parser.parse, text, runner_id)
+
+class TokenBucket:
+    # Paces the requests to the server. Tokens are refilled at `rate` per second, up to `burst` tokens, and each request takes one.
+    # The rate adapts to the server's feedback: it is halved when the server asks to slow down (429 Too Many Requests, 5xx),
+    # and raised by 10% after every 10 consecutive successful requests, up to max_rate.
+
+    def __init__(self, rate, burst, max_rate):
+        self.rate = rate
+        self.min_rate = rate / 16
+        self.max_rate = max_rate
+        self.burst = burst
+        self.tokens = burst
+        self.successes = 0
+        loop = asyncio.get_running_loop()
+        self.time = loop.time
+        self.updated = self.time()
+        # No tokens are handed out until this time, as requested by the server via Retry-After.
+        self.paused_until = self.updated
+
+    async def acquire(self):
+        # Wait until a token is available and take it.
+        while True:
+            now = self.time()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def on_success(self):
+        self.successes += 1
+        if self.successes >= 10:
+            self.rate = min(self.rate * 1.1, self.max_rate)
+            self.successes = 0
+
+    def on_throttle(self, delay):
+        # The server is overloaded. Slow down, and do not send anything for delay seconds.
+        # The requests in flight at once tend to be throttled together, so the rate is only halved once per pause.
+        # The pause lasts at least one token interval at the current rate, even if the server asks for no delay.
+        now = self.time()
+        self.successes = 0
+        if now >= self.paused_until:
+            self.rate = max(self.rate / 2, self.min_rate)
+        self.paused_until = max(self.paused_until, now + max(delay, 1 / self.rate))
+        # The bucket is emptied and only refilled from the end of the pause, so that the requests do not go out in a burst once it is over.
+        self.tokens = 0
+        self.updated = self.paused_until
+
+# Status codes to retry on (429 is Too Many Requests).
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+def retry_after(resp, default):
+    # The delay in seconds that the server asks for in the Retry-After header, or default if there is none.
+    # Only the delay-seconds form of the header is supported.
     try:
-        strong_values = [value.get_text(strip=True) for value in personal.find_all('strong', class_='text-primary')]
-        
-        # The expected order of the values appearance: the event type, runner's ID (which we already have by now), sex, age, residence.
-        res['event'], _, res['sex'], res['age'], res['residence'] = strong_values       
-    except Exception as e:
-        print(f'Warning: unexpected personal data format for runner {runner_id}. Error ({type(e).__name__}: {e})')
-        return {}
-        
-    return res
+        return max(0, int(resp.headers.get('Retry-After')))
+    except (TypeError, ValueError):
+        return default
+
+async def send_request(session, method, url, timeout, bucket=None, retries=5, backoff_factor=1):
+    # Send a request for url within an aiohttp session and return the triple (status, headers, text).
+    # The request is retried on connection errors and RETRY_STATUSES with an exponential backoff, or after the delay given by the server.
+    # The text is only read for a successful GET response and is None otherwise.
+    # The requests are paced by a TokenBucket, if there is one.
+    for attempt in range(retries + 1):
+        if bucket is not None:
+            await bucket.acquire()
+        delay = backoff_factor * 2 ** attempt
+        try:
+            async with session.request(method, url, allow_redirects=False, timeout=timeout) as resp:
+                if resp.status in RETRY_STATUSES:
+                    delay = retry_after(resp, delay)
+                    if bucket is not None:
+                        bucket.on_throttle(delay)
+                elif bucket is not None and not getattr(resp, 'from_cache', False):
+                    bucket.on_success()
+                if resp.status not in RETRY_STATUSES or attempt == retries:
+                    # The undecodable bytes are replaced rather than failing the whole page, as in requests.
+                    text = await resp.text(errors='replace') if resp.status == 200 and method == 'GET' else None
+                    return resp.status, resp.headers, text
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == retries:
+                raise
+        await asyncio.sleep(delay)
+
+async def fetch_page(session, url, timeout, bucket=None, min_length=None):
+    # Download the page at url and return the pair (status, text). The text is None if there is no page to parse.
+    # If min_length is given, the page is probed with a HEAD request first. It is downloaded only if the server reports it as present (200)
+    # and, when the server reports the length, no shorter than min_length bytes. This saves downloading the placeholder pages.
+    # A server that does not support HEAD requests (405 Method Not Allowed, 501 Not Implemented) is not probed.
+    # The responses from the local HTTP cache of a CachedSession are neither probed nor paced.
+    # The cached response is looked up with get_response(), which also drops it once it has expired. An expired page is downloaded again as usual.
+    if isinstance(session, CachedSession) and await session.cache.get_response(str(session.cache.create_key('GET', url))) is not None:
+        bucket, min_length = None, None
+    if min_length is not None:
+        status, headers, _ = await send_request(session, 'HEAD', url, timeout, bucket)
+        length = headers.get('Content-Length', '')
+        if status not in (200, 405, 501) or (status == 200 and length.isdigit() and int(length) < min_length):
+            return status, None
+    status, _, text = await send_request(session, 'GET', url, timeout, bucket)
+    return status, text
+
+def split_info_columns(config_params):
+    # The split fields that make it into the clean dataset. Such fields are named 'split_{i}_<some split info>',
+    # where i is in 1...m and the very last split i=m corresponds to the the finish line. The chip start time is added to them.
+    SPLITS_DISTANCE = config_params['splits']['distance']
+    SPLIT_INFO = config_params['cleaning']['split_info']
+    PANDAS_START_MAP = config_params['splits']['start']
+
+    split_columns = [f'split_{i}_' + col_name for i in range(1, len(SPLITS_DISTANCE) + 1) for col_name in SPLIT_INFO]
+    split_columns.append(PANDAS_START_MAP['ChipStart'])
+    return split_columns
+
+# The split info formats: 'place/total' and the times hh:mm:ss, mm:ss. The time field ranges are checked as datetime.strptime would.
+PLACE_PATTERN = r'^\s*(?P<place>[+-]?\d+)\s*(?:/|$)'
+HMS_PATTERN = r'^(?P<h>[01]?\d|2[0-3]):(?P<m>[0-5]?\d):(?P<s>[0-5]?\d)$'
+MS_PATTERN = r'^(?P<m>[0-5]?\d):(?P<s>[0-5]?\d)$'
+
+def convert_split_info(split_info):
+    # Convert an Arrow array of split info strings to int32 with Arrow compute kernels.
+    # A string of the form 'place/total' representing the overall place of a runner at a split is converted to place.
+    # A string representing time in the format hh:mm:ss, mm:ss is converted to the corresponding total time interval length in seconds.
+    # Anything else is null.
+    def group(pattern, name):
+        return pc.cast(pc.struct_field(pc.extract_regex(split_info, pattern), name), pa.int32())
+
+    # Unlike int(), the integer cast does not take a leading '+', so it is stripped first.
+    place = pc.cast(pc.utf8_ltrim(pc.struct_field(pc.extract_regex(split_info, PLACE_PATTERN), 'place'), '+'), pa.int32())
+    hms_seconds = pc.add(pc.add(pc.multiply(group(HMS_PATTERN, 'h'), 3600), pc.multiply(group(HMS_PATTERN, 'm'), 60)), group(HMS_PATTERN, 's'))
+    ms_seconds = pc.add(pc.multiply(group(MS_PATTERN, 'm'), 60), group(MS_PATTERN, 's'))
+    return pc.cast(pc.coalesce(place, hms_seconds, ms_seconds), pa.int32())
+
+class ParquetSink:
+    # Writes the scraped entries to a Parquet file alongside the output CSV file.
+    # The entries are held back until flush(), which writes them as a single row group. The scraper flushes at its checkpoints,
+    # so that the file does not run ahead of SESSION_FILE and a resumed session does not write the same runners again.
+    # The fields are stored as strings, as in the CSV file, except for the runner ID and numeric_columns.
+    # The split info in numeric_columns is converted to int32 at write time, so that the cleaning does not have to do it.
+    # The file is written under a hidden temporary name, which Parquet readers skip, and only gets its name once the writer is closed.
+    # A crash thus never leaves an unreadable file (one without the footer) behind in place of a part file.
+
+    def __init__(self, path, column_names, runner_id_column, numeric_columns=()):
+        self.raw_schema = pa.schema([(col, pa.int64() if col == runner_id_column else pa.string()) for col in column_names])
+        self.numeric_columns = [col for col in column_names if col in set(numeric_columns)]
+        self.schema = pa.schema([(col, pa.int32()) if col in self.numeric_columns else self.raw_schema.field(col) for col in column_names])
+        self.path = path
+        self.tmp_path = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.tmp')
+        self.writer = pq.ParquetWriter(self.tmp_path, self.schema)
+        self.pending = []
+
+    def write(self, rows):
+        # The rows are tuples of the field values in the order of column_names. The missing values (None) are null.
+        self.pending.extend(rows)
 
-def scrape_race_data(config_params, output_file):
+    def flush(self):
+        rows, self.pending = self.pending, []
+        if not rows:
+            return
+        columns = zip(*rows)
+        table = pa.Table.from_arrays([pa.array(values, type=field.type) for values, field in zip(columns, self.raw_schema)],
+                                     schema=self.raw_schema)
+        for col in self.numeric_columns:
+            i = table.schema.get_field_index(col)
+            table = table.set_column(i, col, convert_split_info(table.column(i)))
+        self.writer.write_table(table)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        # The file is only readable once the writer is closed. The entries that have not been flushed are dropped.
+        self.writer.close()
+        os.replace(self.tmp_path, self.path)
+
+def rebuild_parquet(parquet_dir, csv_file, runner_id_column, numeric_columns=()):
+    # Rewrite the Parquet output in parquet_dir as a single part file with the entries saved in csv_file.
+    # This recovers the Parquet output after a crash has left a part file unfinished.
+    shutil.rmtree(parquet_dir, ignore_errors=True)
+    os.makedirs(parquet_dir)
+    with open(csv_file, 'r', newline='') as f:
+        reader = csv.reader(f)
+        column_names = next(reader)
+        i = column_names.index(runner_id_column)
+        # The empty fields are the missing values.
+        rows = [tuple(int(value) if j == i else value or None for j, value in enumerate(row)) for row in reader]
+    if rows:
+        with ParquetSink(os.path.join(parquet_dir, f'part-{rows[0][i]}.parquet'), column_names, runner_id_column, numeric_columns) as sink:
+            sink.write(rows)
+            sink.flush()
+
+def save_checkpoint(session_file, runner_id, output_size):
+    # Save the last processed runner ID to session_file, followed by the size of the output file that accounts for the runners up to it.
+    # The ID is written to a temporary file first, which then replaces session_file at once,
+    # so that a crash never leaves a truncated session file behind.
+    tmp_file = session_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(f'{runner_id} {output_size}')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, session_file)
+
+async def scrape_race_data(config_params, output_file):
     # For a pool of runner IDs, attempt to download and parse the invidual race reports from the mtecresults server.
     # The results are to be saved in an output CSV file and are returned as a pandas dataframe.
+    # This is a coroutine: run it with asyncio.run() from a script or await it in a notebook.
     
     # The parameters for the scraping session are passed as a yaml dictionary.
         
@@ -87,14 +235,23 @@ def scrape_race_data(config_params, output_file):
     RACE_ID = config_params['scraping']['race_id']
 
     # Some headers spoofing will be needed. The mtecresults server does not return results otherwise.
-    HEADERS = config_params['scraping']['headers']
+    # The reports are requested compressed, unless the config says otherwise. aiohttp decompresses them transparently.
+    HEADERS = {'Accept-Encoding': 'gzip, deflate', **config_params['scraping']['headers']}
 
-    # Scraping might take a while, since we will impose random delays in between requests.
+    # Scraping might take a while, since we will limit the rate of requests.
     # Runners' IDs will be processed in batches, while saving intermediate results to the output file.
     BATCH_SIZE = config_params['scraping']['batch_size']
     OUTPUT_FILE = output_file
     # The last processed runner ID is to be kept in this file.
     SESSION_FILE = output_file + '.session' 
+    # The race reports for a past race do not change, so the successful responses are cached on disk.
+    # A repeated or resumed session reads them from this file instead of the mtecresults server.
+    CACHE_FILE = output_file + '.httpcache'
+    # Optionally, the entries are also saved in the Parquet format. A Parquet file cannot be appended to,
+    # so each session writes its own part file into this directory. pd.read_parquet() reads the directory as a whole.
+    # The CSV file and SESSION_FILE remain the record that a session is resumed from.
+    PARQUET_OUTPUT = config_params['scraping'].get('parquet_output', False)
+    PARQUET_DIR = output_file + '.parquet'
 
     # Runners' IDs are not assigned contiguously, but may appear within the union of some intervals [L1, R1], [L2, R2], ... [Lm, Rm]
     # according to the official status of a runner (competitive/non-competitive) and the starting corral.
@@ -117,12 +274,28 @@ def scrape_race_data(config_params, output_file):
     column_names = []
     if os.path.exists(OUTPUT_FILE):
         try:
-            df = pd.read_csv(OUTPUT_FILE)
-            if not df.empty and os.path.exists(SESSION_FILE):
+            # SESSION_FILE keeps the last processed runner ID and the size of the output file at that point (the older session files only keep the ID).
+            session = []
+            if os.path.exists(SESSION_FILE):
                 with open(SESSION_FILE, 'r') as f:
-                    runner_id_init = int(f.read()) + 1 # Resume from the last ID + 1.
-                column_names = pd.read_csv(OUTPUT_FILE, nrows=0).columns.tolist()                
+                    session = f.read().split()
+            # The rows written after the last checkpoint are dropped. They are to be scraped again.
+            if len(session) > 1 and os.path.getsize(OUTPUT_FILE) > int(session[1]):
+                with open(OUTPUT_FILE, 'r+b') as f:
+                    f.truncate(int(session[1]))
+            # Only the header and the number of saved entries are needed here, so the file is not loaded into a dataframe.
+            with open(OUTPUT_FILE, 'r', newline='') as f:
+                reader = csv.reader(f)
+                header = next(reader, [])
+                saved = sum(1 for _ in reader)
+            if saved and session:
+                runner_id_init = int(session[0]) + 1 # Resume from the last ID + 1.
+                column_names = header
                 print(f'Found a scraping output file {OUTPUT_FILE}.\nResuming at runner ID {runner_id_init}.')
+                # An unfinished part file is left behind by a session that has crashed. The Parquet output is then restored from the CSV file.
+                if PARQUET_OUTPUT and os.path.isdir(PARQUET_DIR) and any(name.endswith('.tmp') for name in os.listdir(PARQUET_DIR)):
+                    print(f'Found an unfinished Parquet part file in {PARQUET_DIR}. Rebuilding the Parquet output from {OUTPUT_FILE}.')
+                    rebuild_parquet(PARQUET_DIR, OUTPUT_FILE, RUNNER_ID, split_info_columns(config_params))
             else:
                 print(f'Found a scraping output file {OUTPUT_FILE}, but the session data is incomplete.')                
         except Exception as e:
@@ -136,8 +309,11 @@ def scrape_race_data(config_params, output_file):
                 column_names.append(f'split_{i}_' + col_name)
         column_names.extend(PANDAS_START_MAP.values()) 
     
-        df = pd.DataFrame(columns=column_names)
-        df.to_csv(OUTPUT_FILE, mode='w', header=True, index=False)
+        with open(OUTPUT_FILE, 'w', newline='') as f:
+            csv.writer(f, lineterminator='\n').writerow(column_names)
+        saved = 0
+        # The Parquet parts of an earlier session are not a part of the new one.
+        shutil.rmtree(PARQUET_DIR, ignore_errors=True)
     
         # A new sessions starts at the lower bound of the first ID interval in the pool
         runner_id_init = RUNNER_IDS_POOL[0][0]
@@ -155,77 +331,121 @@ def scrape_race_data(config_params, output_file):
     print (f'{total} IDs are to be processed.')
 
     # Setting up a communication policy.
-    retry_strategy = Retry(
-        total=5,
-        backoff_factor=1,
-        status_forcelist=[429, 500, 502, 503, 504], # Status codes to retry on (429 is Too Many Requests).
-        allowed_methods=["HEAD", "GET", "OPTIONS"] 
-    )
-    adapter = HTTPAdapter(max_retries=retry_strategy)    
-
-    session = requests.Session()
-    session.mount("http://", adapter)
-    session.mount("https://", adapter)
-
-    saved = len(df)
-    entries_batch = []
+    # Up to CONCURRENCY requests are kept in flight at once, so that the network latency of one runner's report overlaps with the others'.
+    CONCURRENCY = config_params['scraping'].get('concurrency', 8)
+    timeout = aiohttp.ClientTimeout(total=100)
+    sem = asyncio.Semaphore(CONCURRENCY)
+    # Being polite. The requests are paced, adapting to the server's responses.
+    RATE_LIMIT = {'rate': 2.0, 'burst': 5, 'max_rate': 5.0, **config_params['scraping'].get('rate_limit', {})}
+    bucket = TokenBucket(RATE_LIMIT['rate'], RATE_LIMIT['burst'], RATE_LIMIT['max_rate'])
+    # Optionally, skip the runner IDs without a race report with a cheap HEAD request before downloading a page.
+    PROBE_MIN_LENGTH = config_params['scraping'].get('probe_min_length', None)
+    # All the requests go to a single host. The connection pool holds a persistent connection for each request in flight,
+    # and keeps the idle ones alive long enough to be reused after the pauses and retry backoffs.
+    connector = aiohttp.TCPConnector(limit=CONCURRENCY, limit_per_host=CONCURRENCY, keepalive_timeout=60)
+    parser = SplitsParser(config_params)
+
+    async def fetch(session, runner_id):
+        # Download and parse the race report for a single runner.
+        # Returns a pair (runner_id, row), where row is None if the server has not returned a race report.
+        # Each runner ID gets a single task, and the retries happen within it, so a report is never downloaded twice at once.
+        url = URL_TEMPLATE.format(rid=runner_id, race=RACE_ID)
+        async with sem:
+            try:
+                status, text = await fetch_page(session, url, timeout, bucket, PROBE_MIN_LENGTH)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print (f'Error getting data for runner {runner_id} from {url}: {e}. Skipping.')
+                status, text = None, None
+            if status in RETRY_STATUSES:
+                print (f'Error getting data for runner {runner_id} from {url}: the server still responds with {status} after all the retries. Skipping.')
+
+        if status != 200 or text is None:
+            return runner_id, None
+        # The server has returned some content. Presumably, a valid race report.
+        entry = await parse_entry(parser, text, runner_id)
+        # The entry is laid out as a row of the output file. The fields missing in the entry are None, the unknown ones are dropped.
+        return runner_id, tuple([entry.get(col) for col in column_names])
+
+    def save_batch(writer, parquet, rows):
+        # Append the batch of entries to the output CSV file. The missing values (None) are left empty.
+        writer.writerows(rows)
+        if parquet is not None:
+            parquet.write(rows)
+
+    def checkpoint(output, parquet, runner_id):
+        # Save the runner ID processed last. The batches written since the previous checkpoint are committed to disk together:
+        # the rows must be on disk before SESSION_FILE points past them.
+        output.flush()
+        os.fsync(output.fileno())
+        if parquet is not None:
+            parquet.flush()
+        save_checkpoint(SESSION_FILE, runner_id, os.fstat(output.fileno()).st_size)
+
+    runner_ids = list(itertools.chain.from_iterable(runner_id_ranges))
+    # The batch is a list of a fixed size, filled up to batch_len and reused for all the batches.
+    entries_batch = [None] * BATCH_SIZE
+    batch_len = 0
+    # The responses arrive out of order. A finished runner ID is kept in `completed` until all the IDs before it are done,
+    # so that the output file and SESSION_FILE always advance in the order of IDs and a resumed session neither skips nor duplicates a runner.
+    completed = {}
+    next_idx = 0
     # The main scraping loop
-    for runner_id in itertools.chain.from_iterable(runner_id_ranges):
-        try:
-            url = URL_TEMPLATE.format(rid=runner_id, race=RACE_ID)
-            page_content = session.get(url, headers=HEADERS, allow_redirects=False, timeout=100)
-            if page_content.status_code == 200: 
-                # The server has returned some content. Presumably, a valid race report.
-                html_data = bs4.BeautifulSoup(page_content.text, 'html.parser')
-                
-                entry = {'runner_id': runner_id}            
-                entry.update(extract_personal(html_data, runner_id))
-                entry.update(extract_splits(html_data, runner_id, config_params))
-                entries_batch.append(entry)
-                
-            # Saving a batch when it is full or the last processed runner_id is a multiple of 2 * (batch size) to report on progress.
-            if len(entries_batch) >= BATCH_SIZE or not runner_id % (BATCH_SIZE * 2):
-                # Appending a new batch of entries to the output CSV file.
-                df_batch = pd.DataFrame(entries_batch)
-                df_batch = df_batch.reindex(columns=column_names)
-                df_batch.to_csv(OUTPUT_FILE, mode='a', header=False, index=False)                
-                saved += len(entries_batch)   
-                entries_batch.clear()
-                
-                if not runner_id % (BATCH_SIZE * 2):
-                    print (f'Last processed runner ID: {runner_id}; {saved} entries saved.')
-                    
-                # Save the the runner ID processed last for this batch.
-                with open(SESSION_FILE, 'w') as f:
-                    f.write(str(runner_id))
-                
-        except requests.exceptions.RequestException as e:
-            print (f'Error getting data for runner {runner_id} from {url}: {e}. Skipping.')
-            
-        # Being polite.
-        time.sleep(random.uniform(0.5, 1))
-
-    # Appending the final batch, if there is one.
-    if entries_batch:
-        df_batch = pd.DataFrame(entries_batch)
-        df_batch = df_batch.reindex(columns=column_names)
-        df_batch.to_csv(OUTPUT_FILE, mode='a', header=False, index=False)                
-        saved += len(entries_batch)
-        with open(SESSION_FILE, 'w') as f:
-            f.write(str(runner_id))
-        
+    cache = SQLiteBackend(cache_name=CACHE_FILE, expire_after=7 * 24 * 3600, allowed_codes=(200,))
+    if PARQUET_OUTPUT and runner_ids:
+        os.makedirs(PARQUET_DIR, exist_ok=True)
+        parquet_sink = ParquetSink(os.path.join(PARQUET_DIR, f'part-{runner_ids[0]}.parquet'), column_names, RUNNER_ID,
+                                   numeric_columns=split_info_columns(config_params))
+    else:
+        parquet_sink = contextlib.nullcontext()
+    # The output file is kept open for the whole session and the entries are streamed into it row by row.
+    # The writes are buffered and only flushed to disk at the checkpoints.
+    with open(OUTPUT_FILE, 'a', newline='', buffering=1 << 20) as output, parquet_sink as parquet:
+        writer = csv.writer(output, lineterminator='\n')
+        async with CachedSession(cache=cache, headers=HEADERS, connector=connector) as session:
+            tasks = [asyncio.create_task(fetch(session, runner_id)) for runner_id in runner_ids]
+            try:
+                for next_done in asyncio.as_completed(tasks):
+                    done_id, row = await next_done
+                    completed[done_id] = row
+
+                    while next_idx < len(runner_ids) and runner_ids[next_idx] in completed:
+                        runner_id = runner_ids[next_idx]
+                        next_idx += 1
+                        row = completed.pop(runner_id)
+                        if row is not None:
+                            entries_batch[batch_len] = row
+                            batch_len += 1
+
+                        # Saving a batch when it is full or the last processed runner_id is a multiple of 2 * (batch size) to report on progress.
+                        # The session is checkpointed on progress reports only.
+                        if batch_len == BATCH_SIZE or not runner_id % (BATCH_SIZE * 2):
+                            saved += batch_len
+                            save_batch(writer, parquet, entries_batch[:batch_len] if batch_len < BATCH_SIZE else entries_batch)
+                            batch_len = 0
+
+                            if not runner_id % (BATCH_SIZE * 2):
+                                checkpoint(output, parquet, runner_id)
+                                print (f'Last processed runner ID: {runner_id}; {saved} entries saved.')
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+        # Appending the final batch, if there is one.
+        if batch_len:
+            saved += batch_len
+            save_batch(writer, parquet, entries_batch[:batch_len])
+        if runner_ids:
+            checkpoint(output, parquet, runner_ids[-1])
+
     print (f'Data fetching completed. {saved} entrie(s) saved in {OUTPUT_FILE}.')
 
-    return df
+    return pd.read_csv(OUTPUT_FILE)
 
 def clean_race_data(config_params, raw_df):
     # We refine the raw data in raw_df to the only fields that we find useful in our model. 
     # This is customized in config/params.yaml and passed as config_params.
      
     PERSONAL = config_params['cleaning']['personal']
-    SPLITS_DISTANCE = config_params['splits']['distance']
-    SPLIT_INFO = config_params['cleaning']['split_info']
-    PANDAS_START_MAP = config_params['splits']['start']
     FILTER_BY = config_params['cleaning']['filter_by']
     RUNNER_ID = config_params['scraping']['runner_id']
 
@@ -239,26 +459,26 @@ def clean_race_data(config_params, raw_df):
             if key not in raw_df.columns:
                 raise KeyError(f'Wrong dataset format. Column {key} not found.')
             filter_and &= (raw_df[key] == value)
-    raw_df = raw_df[filter_and].copy()
 
-    # We check the raw data for some consistency and build a clean dataset.
+    # Any runner with at least one piece of non-split-related data missing is excluded from the dataset.
     try:
-        clean_df = raw_df[[RUNNER_ID] + PERSONAL].copy()  
+        runners_no_info = filter_and & raw_df[PERSONAL].isnull().any(axis=1)
     except:
         raise KeyError(f'Wrong dataset format.') 
-    
-    # Any runner with at least one piece of non-split-related data missing is excluded from the dataset.
-    runners_no_info = clean_df[PERSONAL].isnull().any(axis=1)
     if runners_no_info.any():
         print ('Warning: The following runners miss personal data and are excluded from the dataset:')
-        print (raw_df[RUNNER_ID][runners_no_info])
-    raw_df = raw_df[~runners_no_info]
+        print (raw_df.loc[runners_no_info, RUNNER_ID])
+    # The raw data is sliced only once, with both filters combined.
+    raw_df = raw_df.loc[filter_and & ~runners_no_info]
+
+    # We check the raw data for some consistency and build a clean dataset.
+    try:
+        clean_df = raw_df[[RUNNER_ID] + PERSONAL].copy()  
+    except:
+        raise KeyError(f'Wrong dataset format.') 
     
-    # A field may contain data for a split. Such fields are named 'split_{i}_<some split info>',
-    # and are always included into the final dataset. Here, i is in 1...m, 
-    # where the very last split i=m corresponds to the the finish line.
-    split_columns = [f'split_{i}_' + col_name for i in range(1, len(SPLITS_DISTANCE) + 1) for col_name in SPLIT_INFO]
-    split_columns.append(PANDAS_START_MAP['ChipStart'])
+    # A field may contain data for a split. Such fields are always included into the final dataset.
+    split_columns = split_info_columns(config_params)
     try:
         clean_df[split_columns] = raw_df[split_columns]  
     except:
@@ -267,29 +487,13 @@ def clean_race_data(config_params, raw_df):
     # Stripping off what should be a state name. Go Minnesota! Ski-U-Mah!
     clean_df['residence'] = raw_df['residence'].map(lambda x: x.split(',')[-1].strip() if ',' in x else '')
 
-    def convert_split_info(split_info):
-        # If the argument is a string representing time in the format hh:mm:ss, mm:ss,
-        # then convert it to the corresponding total time interval length in seconds.
-        # If the argument is a string of the form 'place/total' representing the overall place of a runner at a split, return place as an int.
-        if pd.isna(split_info):
-            return np.nan
-        try: 
-            return int(split_info.split('/')[0])
-        except:
-            pass
-        try:
-            t = datetime.strptime(split_info, '%H:%M:%S').time()
-            return 3600 * t.hour + 60 * t.minute + t.second
-        except ValueError:
-            pass             
-        try:
-            t = datetime.strptime(split_info, '%M:%S').time()
-            return 60 * t.minute + t.second
-        except ValueError:
-            return np.nan
-
-    # Convert split info from strings to numerics. 
-    clean_df[split_columns] = clean_df[split_columns].map(convert_split_info).astype('Int32')
+    # Convert split info from strings to numerics with Arrow compute kernels, see convert_split_info.
+    # The fields that are numeric already (e.g. in the Parquet output of the scraper) are kept as they are.
+    for col in split_columns:
+        if not pd.api.types.is_numeric_dtype(clean_df[col]):
+            split_info = pa.array(clean_df[col], type=pa.string(), from_pandas=True)
+            clean_df[col] = convert_split_info(split_info).to_numpy(zero_copy_only=False)
+    clean_df[split_columns] = clean_df[split_columns].astype('Int32')
 
     clean_df.set_index(RUNNER_ID, inplace=True)
     
@@ -314,7 +518,7 @@ if __name__ == '__main__':
         output_file_relative = config_params['scraping']['output_file']
         output_file_abs = os.path.join(project_root, output_file_relative)
 
-        df = scrape_race_data(config_params, output_file_abs)        
+        df = asyncio.run(scrape_race_data(config_params, output_file_abs))        
         print(df.head())
 
     except FileNotFoundError:
@@ -0,0 +1,16 @@
+# Compiles the race report parser (extract.py) with Cython. This is optional: without it, the parser runs as regular Python.
+# The compiled module is placed next to extract.py and takes precedence over it on import.
+#
+# Usage (from the project root): python src/scraping/setup_extract.py build_ext --inplace
+
+import os
+from setuptools import setup, Extension
+from Cython.Build import cythonize
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+os.chdir(script_dir)
+
+setup(
+    name='mtecresults-extract',
+    ext_modules=cythonize([Extension('extract', ['extract.py'])], language_level=3),
+)